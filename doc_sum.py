@@ -1,12 +1,16 @@
 import os
 import sys
 import time
+import hashlib
+import heapq
 import mimetypes
 import requests
 import json
 from pathlib import Path
 from dotenv import load_dotenv
 
+from document_analyzer import _SESSION, _json_dumps, _json_loads, hash_file, content_md5
+
 # Load .env for AMPLIFY_API_KEY
 load_dotenv()
 
@@ -17,6 +21,144 @@ if not AMPLIFY_API_KEY:
 
 API_BASE = "https://prod-api.vanderbilt.ai"
 
+# Built once; the Authorization header is kept off the session so it never reaches presigned S3 URLs
+AUTH_HEADERS = {"Authorization": f"Bearer {AMPLIFY_API_KEY}"}
+JSON_HEADERS = {**AUTH_HEADERS, "Content-Type": "application/json"}
+
+READY_STATES = {"ready", "processed"}
+
+CACHE_PATH = Path.home() / ".amplify_sum_cache.json"
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Near-duplicate tier: bottom-k MinHash over 5-word shingles, i.e. an estimate of the Jaccard
+# similarity of the two documents' shingle sets. Measured: unrelated documents of the same kind
+# score at most ~0.3 (GPL-2 vs GPL-3 0.13, bz2.py vs lzma.py 0.32), while copies with up to 20
+# edited lines score 0.87-0.99.
+NEAR_DUP_CACHE_PATH = Path.home() / ".amplify_sum_near_dup.json"
+NEAR_DUP_THRESHOLD = 0.85
+NEAR_DUP_SHINGLE_WORDS = 5
+NEAR_DUP_SKETCH_SIZE = 256
+NEAR_DUP_MIN_SHINGLES = 100
+NEAR_DUP_MAX_TEXT_BYTES = 1024 * 1024
+TEXT_MIME_TYPES = {"application/json", "application/xml", "application/javascript"}
+
+
+# ---------------------------
+# Summary cache
+# ---------------------------
+def _load_cache():
+    try:
+        with open(CACHE_PATH, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    now = time.time()
+    return {
+        h: entry for h, entry in cache.items()
+        if isinstance(entry, dict) and now - entry.get("ts", 0) < CACHE_TTL_SECONDS
+    }
+
+
+def _save_cache(cache):
+    tmp_path = CACHE_PATH.with_suffix(".tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as e:
+        print(f"⚠️ Could not write summary cache: {e}")
+
+
+# ---------------------------
+# Near-duplicate summary cache
+# ---------------------------
+def _read_document_text(file_path):
+    """Return the leading text of a plain-text document, or None for binary formats."""
+    mime_type, _ = mimetypes.guess_type(file_path)
+    if not mime_type or not (mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES):
+        return None
+    try:
+        with open(file_path, "rb") as f:
+            return f.read(NEAR_DUP_MAX_TEXT_BYTES).decode("utf-8", errors="replace")
+    except OSError:
+        return None
+
+
+def _minhash_sketch(text):
+    """
+    Bottom-k MinHash of the text's word shingles: the NEAR_DUP_SKETCH_SIZE smallest 64-bit shingle hashes.
+    Returns None for documents too short to compare reliably.
+    """
+    words = text.lower().split()
+    shingles = {
+        " ".join(words[i:i + NEAR_DUP_SHINGLE_WORDS])
+        for i in range(len(words) - NEAR_DUP_SHINGLE_WORDS + 1)
+    }
+    if len(shingles) < NEAR_DUP_MIN_SHINGLES:
+        return None
+    hashes = (
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+        for s in shingles
+    )
+    return sorted(heapq.nsmallest(NEAR_DUP_SKETCH_SIZE, hashes))
+
+
+def _sketch_similarity(a, b):
+    """Estimated Jaccard similarity of two bottom-k sketches."""
+    a_set, b_set = set(a), set(b)
+    union_bottom = heapq.nsmallest(NEAR_DUP_SKETCH_SIZE, a_set | b_set)
+    if not union_bottom:
+        return 0.0
+    return sum(1 for h in union_bottom if h in a_set and h in b_set) / len(union_bottom)
+
+
+class NearDuplicateCache:
+    """Summaries of previously seen documents, matched by estimated Jaccard similarity of their text."""
+
+    def __init__(self, path=NEAR_DUP_CACHE_PATH, threshold=NEAR_DUP_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.entries = []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(entries, list):
+            return
+        now = time.time()
+        self.entries = [
+            e for e in entries
+            if isinstance(e, dict)
+            and isinstance(e.get("sketch"), list)
+            and now - e.get("ts", 0) < CACHE_TTL_SECONDS
+        ]
+
+    def lookup(self, sketch):
+        best, best_sim = None, 0.0
+        for entry in self.entries:
+            sim = _sketch_similarity(entry["sketch"], sketch)
+            if sim > best_sim:
+                best, best_sim = entry, sim
+        if best is not None and best_sim >= self.threshold:
+            return best, best_sim
+        return None, best_sim
+
+    def add(self, sketch, name, summary):
+        self.entries.append({"sketch": sketch, "name": name, "summary": summary, "ts": time.time()})
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Could not write near-duplicate cache: {e}")
+
+
 # ---------------------------
 # Upload file to Amplify
 # ---------------------------
@@ -27,10 +169,7 @@ def upload_file_to_amplify(file_path, knowledge_base="summaries", tags=None):
         mime_type = "application/octet-stream"
 
     upload_url = f"{API_BASE}/files/upload"
-    headers = {
-        "Authorization": f"Bearer {AMPLIFY_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    headers = JSON_HEADERS
 
     payload = {
         "type": mime_type,
@@ -50,22 +189,27 @@ def upload_file_to_amplify(file_path, knowledge_base="summaries", tags=None):
     print("🔎 Upload payload:", json.dumps(payload, indent=2))
 
     try:
-        response = requests.post(upload_url, json=payload, headers=headers, timeout=50)
+        response = _SESSION.post(upload_url, data=_json_dumps(payload), headers=headers, timeout=50)
         response.raise_for_status()
 
-        upload_response = response.json()
+        upload_response = _json_loads(response.content)
         print("✅ Upload response:", json.dumps(upload_response, indent=2))
 
         presigned_url = upload_response.get("uploadUrl")
         if presigned_url:
             print("⏳ Uploading file bytes to presigned URL...")
+            # Content-Length keeps the body streamed from the file; Content-MD5 lets S3 verify it
+            put_headers = {
+                "Content-Length": str(os.path.getsize(file_path)),
+                "Content-MD5": content_md5(file_path),
+            }
             with open(file_path, "rb") as f:
-                put_resp = requests.put(presigned_url, data=f)
+                put_resp = _SESSION.put(presigned_url, data=f, headers=put_headers)
                 put_resp.raise_for_status()
             print("✅ File bytes uploaded successfully")
 
         return upload_response
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"❌ Upload error: {e}")
         if "response" in locals():
             try:
@@ -78,19 +222,29 @@ def upload_file_to_amplify(file_path, knowledge_base="summaries", tags=None):
 # ---------------------------
 # Wait for file processing
 # ---------------------------
-def wait_for_file_processing(file_id, max_attempts=10, wait_seconds=20):
+def wait_for_file_processing(file_id, max_attempts=15, wait_seconds=20, initial_wait=1.0, backoff=1.6):
+    """Poll the file status with exponential backoff (initial_wait, capped at wait_seconds)."""
     status_url = f"{API_BASE}/files/{file_id}/status"
-    headers = {"Authorization": f"Bearer {AMPLIFY_API_KEY}"}
+    headers = dict(AUTH_HEADERS)
+    delay = initial_wait
+    state = None
 
     for attempt in range(1, max_attempts + 1):
         try:
-            response = requests.get(status_url, headers=headers, timeout=30)
-            response.raise_for_status()
-            status_data = response.json()
-            state = status_data.get("status")
-            print(f"⏳ Attempt {attempt}/{max_attempts} - File status: {state}")
+            response = _SESSION.get(status_url, headers=headers, timeout=30)
+            if response.status_code == 304:
+                print(f"⏳ Attempt {attempt}/{max_attempts} - File status unchanged: {state}")
+            else:
+                response.raise_for_status()
+                status_data = _json_loads(response.content)
+                state = status_data.get("status")
+                print(f"⏳ Attempt {attempt}/{max_attempts} - File status: {state}")
 
-            if state == "ready":
+                etag = response.headers.get("ETag")
+                if etag:
+                    headers["If-None-Match"] = etag
+
+            if state in READY_STATES:
                 print("✅ File is ready!")
                 return True
             elif state == "failed":
@@ -99,19 +253,85 @@ def wait_for_file_processing(file_id, max_attempts=10, wait_seconds=20):
         except Exception as e:
             print(f"⚠️ Error checking status: {e}")
 
-        time.sleep(wait_seconds)
+        if attempt < max_attempts:
+            time.sleep(delay)
+            delay = min(delay * backoff, wait_seconds)
 
     print("❌ File did not become available in time.")
     return False
 
 
+def _upload_reports_ready(upload_response):
+    """True if the upload response already carries a terminal 'ready' status."""
+    nested = upload_response.get("file")
+    states = [upload_response.get("status")]
+    if isinstance(nested, dict):
+        states.append(nested.get("status"))
+    return any(state in READY_STATES for state in states)
+
+
+def wait_for_file_events(file_id, timeout=300):
+    """
+    Wait on the file's server-sent-events stream for a terminal status.
+    Returns True/False for ready/failed, or None if the stream is unavailable (caller should poll).
+    """
+    events_url = f"{API_BASE}/files/{file_id}/events"
+    headers = {**AUTH_HEADERS, "Accept": "text/event-stream"}
+
+    try:
+        with _SESSION.get(events_url, headers=headers, stream=True, timeout=(10, timeout)) as response:
+            if response.status_code in (404, 405, 501):
+                print("ℹ️ Status event stream not available; falling back to polling.")
+                return None
+            response.raise_for_status()
+            print("⏳ Listening for file status events...")
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("event:"):
+                    continue
+                event = line[len("event:"):].strip()
+                print(f"⏳ File status event: {event}")
+                if event in READY_STATES:
+                    print("✅ File is ready!")
+                    return True
+                if event == "failed":
+                    print("❌ File processing failed.")
+                    return False
+    except requests.exceptions.RequestException as e:
+        print(f"⚠️ Status event stream error: {e}; falling back to polling.")
+        return None
+
+    print("⚠️ Status event stream ended without a final status; falling back to polling.")
+    return None
+
+
 # ---------------------------
 # Summarize the document
 # ---------------------------
-def summarize_document(file_path):
+def summarize_document(file_path, use_sse=False):
     print("=== Document Summarization Pipeline (Single File) ===")
     print(f"📄 File: {file_path}")
 
+    file_hash = hash_file(file_path)
+    if not file_hash:
+        print(f"❌ Could not read file: {file_path}")
+        return
+    cache = _load_cache()
+    cached = cache.get(file_hash)
+    if cached and cached.get("summary"):
+        print("♻️ Using cached summary (file unchanged since last run)")
+        print("📑 Summary:", cached["summary"])
+        return
+
+    near_dup_cache = NearDuplicateCache()
+    text = _read_document_text(file_path)
+    sketch = _minhash_sketch(text) if text else None
+    if sketch:
+        match, similarity = near_dup_cache.lookup(sketch)
+        if match:
+            print(f"♻️ Using cached summary of near-duplicate '{match['name']}' (similarity {similarity:.2f})")
+            print("📑 Summary:", match["summary"])
+            return
+
     upload_response = upload_file_to_amplify(file_path)
     if not upload_response:
         print("❌ Upload failed.")
@@ -123,15 +343,18 @@ def summarize_document(file_path):
         print(json.dumps(upload_response, indent=2))
         return
 
-    if not wait_for_file_processing(file_id):
-        return
+    if _upload_reports_ready(upload_response):
+        print("✅ File already processed at upload time.")
+    else:
+        ready = wait_for_file_events(file_id) if use_sse else None
+        if ready is None:
+            ready = wait_for_file_processing(file_id)
+        if not ready:
+            return
 
     # Ask the LLM to summarize
     summarize_url = f"{API_BASE}/responses"
-    headers = {
-        "Authorization": f"Bearer {AMPLIFY_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    headers = JSON_HEADERS
     payload = {
         "input": f"Please summarize the document: {os.path.basename(file_path)}",
         "fileIds": [file_id],
@@ -139,11 +362,22 @@ def summarize_document(file_path):
     }
 
     try:
-        response = requests.post(summarize_url, json=payload, headers=headers, timeout=120)
+        response = _SESSION.post(summarize_url, data=_json_dumps(payload), headers=headers, timeout=120)
         response.raise_for_status()
-        result = response.json()
+        result = _json_loads(response.content)
         print("📑 Summary:", result.get("outputText", "No summary returned."))
-    except requests.exceptions.RequestException as e:
+
+        if result.get("outputText"):
+            cache[file_hash] = {
+                "summary": result.get("outputText"),
+                "file_id": file_id,
+                "ts": time.time(),
+            }
+            _save_cache(cache)
+            if sketch:
+                near_dup_cache.add(sketch, os.path.basename(file_path), result.get("outputText"))
+                near_dup_cache.save()
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"❌ Summarization error: {e}")
         if "response" in locals():
             try:
@@ -156,15 +390,18 @@ def summarize_document(file_path):
 # Entry point
 # ---------------------------
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python doc_sum.py <file_path>")
+    args = sys.argv[1:]
+    use_sse = "--sse" in args
+    args = [a for a in args if a != "--sse"]
+    if not args:
+        print("Usage: python doc_sum.py [--sse] <file_path>")
         sys.exit(1)
 
-    file_path = sys.argv[1]
+    file_path = args[0]
     if not Path(file_path).is_file():
         print(f"❌ File not found: {file_path}")
         sys.exit(1)
 
-    summarize_document(file_path)
+    summarize_document(file_path, use_sse=use_sse)
 
 
@@ -2,9 +2,9 @@
 """
 document_analyzer.py
 
-Scans a directory, uploads files to Amplify, asks Amplify (LLM) to produce a Windows
-command prompt script (mkdir/copy/move) that organizes those actual files, and saves
-the resulting commands to a .bat file for you to review/run.
+Scans a directory, uploads files to Amplify, asks Amplify (LLM) to assign those actual
+files to folders, and turns the assignments into a Windows command prompt script
+(mkdir/move) saved to a .bat file for you to review/run.
 
 Preserves your OneDrive hydration helpers and uses the Amplify endpoints you've been using.
 """
@@ -17,9 +17,18 @@ import datetime
 import mimetypes
 import sys
 import argparse
+import ntpath
+import threading
+import hashlib
+import base64
+import functools
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import platform
 import tempfile
@@ -27,9 +36,58 @@ import subprocess
 import shutil
 import ctypes
 
+try:
+    import orjson  # optional: faster JSON encode/decode for API bodies
+except ImportError:
+    orjson = None
+
 # Load environment variables from .env file
 load_dotenv()
 
+# Number of files uploaded/polled concurrently in generate_organization_plan
+UPLOAD_WORKERS = 8
+# Number of OneDrive placeholders hydrated concurrently
+HYDRATE_WORKERS = 8
+# Guards the claimed-id sets shared by concurrent wait_for_file_processing calls
+_CLAIMED_IDS_LOCK = threading.Lock()
+
+
+def _build_session():
+    """Shared keep-alive session so repeated API calls reuse TCP/TLS connections."""
+    session = requests.Session()
+    # Only idempotent reads are retried: POSTs are not safe to repeat and streamed PUT bodies cannot be replayed
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"GET", "HEAD"}),
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = _build_session()
+
+# Maps sha256(file bytes) -> Amplify file id so unchanged files are not re-uploaded. Entries expire
+# so the liveness check never has to page back through more than a week of uploads.
+FILE_ID_CACHE_PATH = Path.home() / ".amplify_file_cache.json"
+FILE_ID_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Per-directory {path: {mtime_ns, size, sha256}} index so unchanged files are not re-hashed
+SCAN_INDEX_PATH = Path.home() / ".amplify_scan_cache.json"
+
+
+def _json_loads(data):
+    """Decode a JSON response body, using orjson when it is installed."""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _json_dumps(obj):
+    """Encode a JSON request body as bytes, using orjson when it is installed."""
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode("utf-8")
+
 
 def validate_api_key():
     """Validate that the API key is available"""
@@ -49,8 +107,13 @@ def get_headers():
     return {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"}
 
 
-def query_files():
-    """Query files already uploaded to Amplify"""
+def query_files(
+    start_date: Optional[datetime.datetime] = None,
+    page_index: int = 0,
+    page_size: int = 100,
+    forward_scan: bool = True,
+):
+    """Query files already uploaded to Amplify (default: since the start of yesterday, oldest first)"""
     headers = get_headers()
     if not headers:
         return None
@@ -58,33 +121,26 @@ def query_files():
     base_url = "https://prod-api.vanderbilt.ai"
     query_url = f"{base_url}/files/query"
 
+    if start_date is None:
+        start_date = datetime.datetime.now() - datetime.timedelta(days=1)
+
     payload = {
         "data": {
-            "startDate": f"{(datetime.datetime.now() - datetime.timedelta(days=1)).strftime('%Y-%m-%dT00:00:00Z')}",
-            "pageSize": 100,
-            "pageIndex": 0,
-            "forwardScan": True,
+            "startDate": start_date.strftime("%Y-%m-%dT00:00:00Z"),
+            "pageSize": page_size,
+            "pageIndex": page_index,
+            "forwardScan": forward_scan,
             "sortIndex": "createdAt",
-            "types": [
-                "text/plain",
-                "text/x-python",
-                "application/json",
-                "text/xml",
-                "text/html",
-                "application/pdf",
-                "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-            ],
+            "types": QUERY_FILE_TYPES,
             "tags": [],
         }
     }
 
     try:
-        response = requests.post(query_url, json=payload, headers=headers, timeout=30)
+        response = _SESSION.post(query_url, data=_json_dumps(payload), headers=headers, timeout=30)
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        return _json_loads(response.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"❌ Error querying files: {e}")
         return None
 
@@ -92,18 +148,27 @@ def query_files():
 # Windows attribute constants
 FILE_ATTRIBUTE_OFFLINE = 0x1000
 FILE_ATTRIBUTE_RECALL_ON_OPEN = 0x4000
+_PLACEHOLDER_MASK = FILE_ATTRIBUTE_OFFLINE | FILE_ATTRIBUTE_RECALL_ON_OPEN
+INVALID_FILE_ATTRIBUTES = 0xFFFFFFFF
+
+# Resolve GetFileAttributesW once at import instead of on every call
+_GetFileAttributesW = None
+if platform.system() == "Windows":
+    try:
+        _GetFileAttributesW = ctypes.windll.kernel32.GetFileAttributesW
+        _GetFileAttributesW.argtypes = [ctypes.c_wchar_p]
+        _GetFileAttributesW.restype = ctypes.c_uint32
+    except Exception:
+        _GetFileAttributesW = None
 
 
 def get_file_attributes_windows(path: str) -> Optional[int]:
     """Return Windows file attributes or None on error."""
-    if platform.system() != "Windows":
+    if _GetFileAttributesW is None:
         return None
     try:
-        GetFileAttributesW = ctypes.windll.kernel32.GetFileAttributesW
-        GetFileAttributesW.argtypes = [ctypes.c_wchar_p]
-        GetFileAttributesW.restype = ctypes.c_uint32
-        attrs = GetFileAttributesW(str(path))
-        if attrs == 0xFFFFFFFF:
+        attrs = _GetFileAttributesW(str(path))
+        if attrs == INVALID_FILE_ATTRIBUTES:
             return None
         return int(attrs)
     except Exception:
@@ -115,7 +180,7 @@ def is_onedrive_placeholder(path: str) -> bool:
     attrs = get_file_attributes_windows(path)
     if attrs is None:
         return False
-    return bool(attrs & FILE_ATTRIBUTE_OFFLINE or attrs & FILE_ATTRIBUTE_RECALL_ON_OPEN)
+    return bool(attrs & _PLACEHOLDER_MASK)
 
 
 def hydrate_file_with_robocopy(path: str, timeout_seconds: int = 1000) -> Optional[str]:
@@ -150,6 +215,48 @@ def hydrate_file_with_robocopy(path: str, timeout_seconds: int = 1000) -> Option
         return None
 
 
+def advise_sequential_read(file) -> None:
+    """
+    Hint the kernel that the file will be read front to back so it starts readahead
+    (and, with WILLNEED, prefetches the whole file) ahead of the first hashing pass;
+    the upload that follows then streams the file from the page cache.
+    No-op on platforms without posix_fadvise (e.g. Windows).
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = file.fileno()
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+def hydrate_files_with_robocopy(paths: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Hydrate several OneDrive placeholders concurrently (OneDrive downloads them in parallel).
+    Returns {path: hydrated copy or None}; see hydrate_file_with_robocopy.
+    """
+    if not paths:
+        return {}
+    print(f"🔁 Hydrating {len(paths)} OneDrive placeholder(s) (robocopy, {HYDRATE_WORKERS} at a time)...")
+    with ThreadPoolExecutor(max_workers=HYDRATE_WORKERS) as executor:
+        hydrated = dict(zip(paths, executor.map(hydrate_file_with_robocopy, paths)))
+    for path, hydrated_path in hydrated.items():
+        if hydrated_path:
+            print(f"✅ Hydrated copy created at: {hydrated_path}")
+        else:
+            print(f"⚠️ Hydration via robocopy failed for {path}; will try opening the original file directly.")
+    return hydrated
+
+
+def cleanup_hydrated_copies(hydrated: Dict[str, Optional[str]]) -> None:
+    """Remove the temporary folders created by hydrate_files_with_robocopy."""
+    for hydrated_path in hydrated.values():
+        if hydrated_path:
+            shutil.rmtree(os.path.dirname(hydrated_path), ignore_errors=True)
+
+
 def upload_file_to_amplify(
     file_path,
     knowledge_base="documentation",
@@ -157,8 +264,15 @@ def upload_file_to_amplify(
     actions=None,
     rag_on=False,
     group_id=None,
+    local_path=None,
+    skip_placeholder_check=False,
 ):
-    """Upload a file to Amplify using the files/upload endpoint"""
+    """
+    Upload a file to Amplify using the files/upload endpoint.
+    If local_path is given (e.g. an already hydrated copy of file_path), the bytes are read from it.
+    skip_placeholder_check=True reads file_path as is, for callers that already detected
+    (and hydrated) OneDrive placeholders themselves.
+    """
     headers = get_headers()
     if not headers:
         return None
@@ -170,8 +284,10 @@ def upload_file_to_amplify(
     temp_copy_dir = None
     file_to_open = file_path
     try:
+        if local_path:
+            file_to_open = local_path
         # If Windows + OneDrive placeholder, attempt to hydrate via robocopy
-        if platform.system() == "Windows" and is_onedrive_placeholder(file_path):
+        elif not skip_placeholder_check and platform.system() == "Windows" and is_onedrive_placeholder(file_path):
             print(f"🔁 Detected OneDrive placeholder for: {file_path} — attempting to hydrate (robocopy)...")
             hydrated_path = hydrate_file_with_robocopy(file_path)
             if hydrated_path:
@@ -188,7 +304,9 @@ def upload_file_to_amplify(
         upload_url = f"{base_url}/files/upload"
 
         file_name = os.path.basename(file_path)
-        mime_type, _ = mimetypes.guess_type(file_path)
+        mime_type = _EXT_TO_MIME.get(os.path.splitext(file_name)[1].lower())
+        if mime_type is None:
+            mime_type, _ = mimetypes.guess_type(file_path)
         if mime_type is None:
             mime_type = "text/plain"
 
@@ -218,10 +336,10 @@ def upload_file_to_amplify(
             payload["data"]["groupId"] = group_id
 
         # Request upload metadata (presigned URL)
-        response = requests.post(upload_url, json=payload, headers=headers, timeout=50
+        response = _SESSION.post(upload_url, data=_json_dumps(payload), headers=headers, timeout=50
                                 )
         response.raise_for_status()
-        upload_response = response.json()
+        upload_response = _json_loads(response.content)
 
         if not upload_response.get("success"):
             print(f"❌ Upload failed - {upload_response.get('error', 'Unknown error')}")
@@ -232,12 +350,15 @@ def upload_file_to_amplify(
             print("❌ Error: No upload URL received from server")
             return None
 
-        # Read the (possibly hydrated) file contents
+        # Stream the (possibly hydrated) file straight from disk instead of reading it into memory;
+        # Content-MD5 lets S3 reject a corrupted upload instead of storing it
+        s3_headers = {
+            "Content-Type": mime_type,
+            "Content-Length": str(os.path.getsize(file_to_open)),
+            "Content-MD5": content_md5(file_to_open),
+        }
         with open(file_to_open, "rb") as file:
-            file_content = file.read()
-
-        s3_headers = {"Content-Type": mime_type}
-        s3_response = requests.put(presigned_url, data=file_content, headers=s3_headers, timeout=1000)
+            s3_response = _SESSION.put(presigned_url, data=file, headers=s3_headers, timeout=1000)
         s3_response.raise_for_status()
 
         print(f"✅ File uploaded successfully: {file_name}")
@@ -300,111 +421,577 @@ def chat_with_amplify(
         payload["data"]["options"]["assistantId"] = assistant_id
 
     try:
-        response = requests.post(chat_url, json=payload, headers=headers, timeout=1000)
+        response = _SESSION.post(chat_url, data=_json_dumps(payload), headers=headers, timeout=1000)
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        return _json_loads(response.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"❌ Error chatting with Amplify: {e}")
         return None
 
 
-def wait_for_file_processing(file_name, max_attempts=2, wait_seconds=20):
-    """Wait for a file to be processed and available for use"""
+def _parse_created_at(value: Any) -> Optional[datetime.datetime]:
+    """Parse a /files/query createdAt timestamp into an aware UTC datetime."""
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def list_live_file_ids(since: float, max_pages: int = 50, page_size: int = 100) -> Tuple[set, bool]:
+    """
+    Ids of all files uploaded since the given timestamp, paging through /files/query.
+    Also returns whether the listing is complete (False if a query failed or max_pages ran out).
+    """
+    start_date = datetime.datetime.fromtimestamp(since) - datetime.timedelta(days=1)
+    live_ids = set()
+    for page_index in range(max_pages):
+        files_response = query_files(start_date=start_date, page_index=page_index, page_size=page_size)
+        if not files_response:
+            return live_ids, False
+        items = files_response.get("data", {}).get("items", [])
+        live_ids.update(item.get("id") for item in items)
+        if len(items) < page_size:
+            return live_ids, True
+    return live_ids, False
+
+
+def _file_matches(file_info: Dict[str, Any], file_name: str, file_key: Optional[str]) -> bool:
+    """Match a /files/query item to an upload: by its id/key when known, else by name."""
+    if file_key:
+        return file_key in (file_info.get("id"), file_info.get("key"))
+    return file_info.get("name") == file_name
+
+
+def wait_for_file_processing(
+    file_name,
+    max_attempts=7,
+    wait_seconds=20,
+    initial_wait=1.0,
+    backoff=1.6,
+    file_key=None,
+    claimed_ids=None,
+    uploaded_after=None,
+):
+    """Wait for a file to be processed and available for use.
+
+    Polls with exponential backoff starting at initial_wait seconds and capped at wait_seconds.
+    file_key (the id/key from the upload response) identifies the upload exactly. Without it the
+    file is matched by name, newest first, skipping files created before uploaded_after (a UTC
+    datetime) so an earlier upload of the same name is not mistaken for this one; pass a shared
+    claimed_ids set when several same-named files are being uploaded concurrently so each call
+    returns a different id.
+    """
     print(f"⏳ Waiting for file '{file_name}' to be processed...")
 
+    delay = initial_wait
     for attempt in range(1, max_attempts + 1):
         print(f"  Attempt {attempt}/{max_attempts} - Checking if file is available...")
-        files_response = query_files()
+        files_response = query_files(forward_scan=False)
         if not files_response:
             print("  ❌ Could not query files")
-            time.sleep(wait_seconds)
-            continue
-        files_list = files_response.get("data", {}).get("items", [])
-        for file_info in files_list:
-            if file_info.get("name") == file_name:
+        else:
+            files_list = files_response.get("data", {}).get("items", [])
+            for file_info in files_list:
+                if not _file_matches(file_info, file_name, file_key):
+                    continue
+                if not file_key and uploaded_after is not None:
+                    created_at = _parse_created_at(file_info.get("createdAt"))
+                    if created_at is None or created_at < uploaded_after:
+                        continue
                 file_id = file_info.get("id")
+                if claimed_ids is not None:
+                    with _CLAIMED_IDS_LOCK:
+                        if file_id in claimed_ids:
+                            continue
+                        claimed_ids.add(file_id)
                 print(f"✅ File is now available! ID: {file_id}")
                 return file_id
         if attempt < max_attempts:
-            print(f"  File not ready yet. Waiting {wait_seconds} seconds...")
-            time.sleep(wait_seconds)
+            print(f"  File not ready yet. Waiting {delay:.1f} seconds...")
+            time.sleep(delay)
+            delay = min(delay * backoff, wait_seconds)
     print("❌ File did not become available in time")
     return None
 
 
+def _digest_file(path: str, digest):
+    """Feed a file's bytes into a hashlib object and return it; raises OSError if unreadable."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest
+        advise_sequential_read(f)
+        try:
+            # mmap avoids a read syscall + copy per chunk; hashlib releases the GIL while hashing it
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+        except (ValueError, OSError):
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest
+
+
+def hash_file(path: str) -> Optional[str]:
+    """Return the SHA-256 hex digest of a file's bytes, or None if it cannot be read."""
+    try:
+        return _digest_file(path, hashlib.sha256()).hexdigest()
+    except OSError:
+        return None
+
+
+def content_md5(path: str) -> str:
+    """Base64 MD5 of a file's bytes, as expected by S3's Content-MD5 header."""
+    return base64.b64encode(_digest_file(path, hashlib.md5()).digest()).decode("ascii")
+
+
+def load_file_id_cache() -> Dict[str, Dict[str, Any]]:
+    """Load the content-hash -> uploaded file id cache (empty if missing or unreadable), minus expired entries."""
+    try:
+        with open(FILE_ID_CACHE_PATH, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    now = time.time()
+    return {
+        h: entry for h, entry in cache.items()
+        if isinstance(entry, dict) and now - entry.get("uploaded_at", 0) < FILE_ID_CACHE_TTL_SECONDS
+    }
+
+
+def save_file_id_cache(cache: Dict[str, Dict[str, Any]]) -> None:
+    """Persist the content-hash -> uploaded file id cache."""
+    tmp_path = FILE_ID_CACHE_PATH.with_suffix(".tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, FILE_ID_CACHE_PATH)
+    except OSError as e:
+        print(f"⚠️ Could not save file id cache: {e}")
+
+
+SUPPORTED_FILE_EXTENSIONS = (
+    ".py", ".js", ".ts", ".java", ".cpp", ".c", ".cs", ".php", ".rb", ".go",
+    ".rs", ".swift", ".kt", ".scala", ".r", ".m", ".pl", ".sh", ".sql", ".html",
+    ".css", ".xml", ".json", ".yaml", ".yml", ".md", ".txt", ".pdf", ".docx", ".pptx", ".xlsx"
+)
+_SUPPORTED_EXTS = frozenset(SUPPORTED_FILE_EXTENSIONS)
+_SKIP_DIRS = frozenset({".git", "__pycache__", "node_modules", ".venv", "venv", "env"})
+
+# MIME type per supported extension, resolved once instead of calling mimetypes.guess_type per upload
+mimetypes.init()
+_EXT_TO_MIME = {ext: mimetypes.types_map.get(ext, "text/plain") for ext in _SUPPORTED_EXTS}
+
+# Every MIME type we upload, so /files/query also lists e.g. .md/.js/.yaml/.css uploads
+QUERY_FILE_TYPES = sorted(set(_EXT_TO_MIME.values()) | {
+    "text/plain",
+    "text/x-python",
+    "application/json",
+    "text/xml",
+    "text/html",
+    "application/pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+})
+
+# Above this many files the organization prompt lists per-extension summaries instead of every file
+COMPACT_PROMPT_THRESHOLD = 50
+COMPACT_SAMPLE_SIZE = 10
+
+
 def get_supported_file_extensions():
     """Get list of supported file extensions"""
+    return list(SUPPORTED_FILE_EXTENSIONS)
+
+
+def load_scan_index(directory_path: str) -> Dict[str, Dict[str, Any]]:
+    """Load the scan index recorded for a directory by the previous scan."""
+    try:
+        with open(SCAN_INDEX_PATH, "r", encoding="utf-8") as f:
+            all_indexes = json.load(f)
+        index = all_indexes.get(os.path.abspath(directory_path), {})
+        return index if isinstance(index, dict) else {}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def save_scan_index(directory_path: str, index: Dict[str, Dict[str, Any]]) -> None:
+    """Store the scan index for a directory, keeping the indexes of other directories."""
+    try:
+        with open(SCAN_INDEX_PATH, "r", encoding="utf-8") as f:
+            all_indexes = json.load(f)
+        if not isinstance(all_indexes, dict):
+            all_indexes = {}
+    except (OSError, ValueError):
+        all_indexes = {}
+    all_indexes[os.path.abspath(directory_path)] = index
+    tmp_path = SCAN_INDEX_PATH.with_suffix(".tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(all_indexes, f)
+        os.replace(tmp_path, SCAN_INDEX_PATH)
+    except OSError as e:
+        print(f"⚠️ Could not save scan index: {e}")
+
+
+def get_file_hashes(
+    directory_path: str,
+    file_paths: List[str],
+    local_paths: Optional[Dict[str, str]] = None,
+) -> Dict[str, Optional[str]]:
+    """
+    Content hashes for scanned files, reusing the scan index for files whose mtime/size are unchanged.
+    local_paths optionally maps a scanned path to a local copy (e.g. hydrated) to read instead.
+    """
+    index = load_scan_index(directory_path)
+    local_paths = local_paths or {}
+    hashes = {}
+    to_hash = []
+    for path in file_paths:
+        entry = index.get(path)
+        if entry is not None and entry.get("sha256"):
+            hashes[path] = entry["sha256"]
+        else:
+            to_hash.append(path)
+
+    if to_hash:
+        # Hash uncached files in parallel; hashlib releases the GIL on large buffers
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+            digests = executor.map(hash_file, [local_paths.get(path, path) for path in to_hash])
+            for path, digest in zip(to_hash, digests):
+                hashes[path] = digest
+                if digest and path in index:
+                    index[path]["sha256"] = digest
+        save_scan_index(directory_path, index)
+    return hashes
+
+
+def relative_paths(directory_path: str, paths: List[str]) -> List[str]:
+    """
+    Paths relative to directory_path. Scanned paths all start with directory_path, so the prefix
+    is sliced off directly; anything else falls back to os.path.relpath.
+    """
+    prefix = os.path.join(directory_path, "")
+    prefix_len = len(prefix)
     return [
-        ".py", ".js", ".ts", ".java", ".cpp", ".c", ".cs", ".php", ".rb", ".go",
-        ".rs", ".swift", ".kt", ".scala", ".r", ".m", ".pl", ".sh", ".sql", ".html",
-        ".css", ".xml", ".json", ".yaml", ".yml", ".md", ".txt", ".pdf", ".docx", ".pptx", ".xlsx"
+        path[prefix_len:] if path.startswith(prefix) else os.path.relpath(path, start=directory_path)
+        for path in paths
     ]
 
 
-def scan_directory_for_files(directory_path: str) -> List[str]:
-    """Scan a directory for supported files"""
+def scan_directory_entries(directory_path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Scan a directory for supported files.
+    Returns {path: {mtime_ns, size, placeholder[, sha256]}} in scan order; "placeholder" comes from the
+    attributes the directory enumeration already returned (Windows), so no per-file FFI call is needed.
+    """
     if not os.path.exists(directory_path) or not os.path.isdir(directory_path):
         print(f"❌ Error: Directory not found or not a directory: {directory_path}")
-        return []
+        return {}
+
+    previous_index = load_scan_index(directory_path)
+    index: Dict[str, Dict[str, Any]] = {}
+    unchanged = 0
+
+    def scan(dir_path: str) -> None:
+        nonlocal unchanged
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in _SKIP_DIRS:
+                            subdirs.append(entry.path)
+                        continue
+                    # Symlinks to directories (not descended, like os.walk) and broken links are not files
+                    if not entry.is_file():
+                        continue
+                    file_ext = os.path.splitext(entry.name)[1].lower()
+                    if file_ext not in _SUPPORTED_EXTS:
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    previous = previous_index.get(entry.path)
+                    if previous and previous.get("mtime_ns") == st.st_mtime_ns and previous.get("size") == st.st_size:
+                        index[entry.path] = previous
+                        unchanged += 1
+                    else:
+                        index[entry.path] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+                    # Refreshed every scan: hydrating/dehydrating a file does not change its mtime
+                    index[entry.path]["placeholder"] = bool(getattr(st, "st_file_attributes", 0) & _PLACEHOLDER_MASK)
+                    print(f"  ✅ Found: {entry.path}")
+        except OSError as e:
+            print(f"⚠️ Could not scan {dir_path}: {e}")
+        for subdir in subdirs:
+            scan(subdir)
 
-    supported_extensions = get_supported_file_extensions()
-    supported_files = []
     print(f"📂 Scanning directory: {directory_path}")
-    for root, dirs, files in os.walk(directory_path):
-        dirs[:] = [d for d in dirs if d not in [".git", "__pycache__", "node_modules", ".venv", "venv", "env"]]
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_ext = os.path.splitext(file)[1].lower()
-            if file_ext in supported_extensions:
-                supported_files.append(file_path)
-                print(f"  ✅ Found: {file_path}")
-    print(f"📊 Total supported files found: {len(supported_files)}")
-    return supported_files
-
-
-def _extract_text_from_amplify_response(resp: Dict[str, Any]) -> str:
+    scan(directory_path)
+    save_scan_index(directory_path, index)
+    print(f"📊 Total supported files found: {len(index)} ({unchanged} unchanged since last scan)")
+    return index
+
+
+def scan_directory_for_files(directory_path: str) -> List[str]:
+    """Scan a directory for supported files"""
+    return list(scan_directory_entries(directory_path))
+
+
+class _AmplifyTextExtractor:
     """
     Robust extraction of textual content from Amplify's chat response.
     Tries several common shapes and falls back to a stringified 'data' if needed.
+
+    A server answers in the same shape for a whole session, so the key path that produced
+    text last time is remembered and tried first; the full shape scan only runs on a miss.
     """
-    if not resp:
-        return ""
-    # common shape: { "data": { "choices": [ { "message": { "content": "..." } } ] } }
-    try:
-        choices = resp.get("data", {}).get("choices")
-        if isinstance(choices, list) and len(choices) > 0:
-            first = choices[0]
-            # try nested content keys
-            msg = first.get("message") or first.get("response") or {}
-            if isinstance(msg, dict):
-                content = msg.get("content") or msg.get("text") or msg.get("body")
-                if content:
-                    return content if isinstance(content, str) else json.dumps(content)
-            # direct text field
-            text = first.get("text") or first.get("content")
-            if text:
-                return text if isinstance(text, str) else json.dumps(text)
-    except Exception:
-        pass
 
-    # fallback: sometimes top-level data contains a string or 'output'
-    try:
-        data_field = resp.get("data")
-        if isinstance(data_field, str):
-            return data_field
+    def __init__(self):
+        self._fast_path: Optional[Tuple[Any, ...]] = None
+
+    def __call__(self, resp: Dict[str, Any]) -> str:
+        if not resp:
+            return ""
+        if self._fast_path is not None:
+            try:
+                value = functools.reduce(lambda obj, key: obj[key], self._fast_path, resp)
+            except (KeyError, IndexError, TypeError):
+                value = None
+            if isinstance(value, str) and value:
+                return value
+        text, path = self._scan(resp)
+        if path is not None:
+            self._fast_path = path
+        return text
+
+    @staticmethod
+    def _scan(resp: Dict[str, Any]) -> Tuple[str, Optional[Tuple[Any, ...]]]:
+        """Return (text, key path to the text) — the path is None for non-string fallbacks."""
+        data_field = resp.get("data") if isinstance(resp, dict) else None
+
         if isinstance(data_field, dict):
-            # common fallback keys
-            for k in ("output", "text", "content"):
-                if k in data_field and isinstance(data_field[k], str):
-                    return data_field[k]
-    except Exception:
-        pass
+            # common shape: { "data": { "choices": [ { "message": { "content": "..." } } ] } }
+            choices = data_field.get("choices")
+            if isinstance(choices, list) and len(choices) > 0 and isinstance(choices[0], dict):
+                first = choices[0]
+                # try nested content keys
+                msg_key = "message" if first.get("message") else "response"
+                msg = first.get(msg_key) or {}
+                if isinstance(msg, dict):
+                    for key in ("content", "text", "body"):
+                        content = msg.get(key)
+                        if content:
+                            if isinstance(content, str):
+                                return content, ("data", "choices", 0, msg_key, key)
+                            return json.dumps(content, default=str), None
+                # direct text field
+                for key in ("text", "content"):
+                    text = first.get(key)
+                    if text:
+                        if isinstance(text, str):
+                            return text, ("data", "choices", 0, key)
+                        return json.dumps(text, default=str), None
+
+            # fallback: common top-level keys inside 'data'
+            for key in ("output", "text", "content"):
+                if isinstance(data_field.get(key), str):
+                    return data_field[key], ("data", key)
+
+        # sometimes top-level data is just a string
+        if isinstance(data_field, str):
+            return data_field, ("data",)
+
+        # As last resort, stringify entire response
+        try:
+            return json.dumps(resp), None
+        except Exception:
+            return str(resp), None
 
-    # As last resort, stringify entire response
+
+_extract_text_from_amplify_response = _AmplifyTextExtractor()
+
+
+def _parse_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """Parse the first JSON object in an LLM reply, tolerating code fences or stray prose."""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
     try:
-        return json.dumps(resp)
-    except Exception:
-        return str(resp)
+        parsed = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+# Characters Windows does not allow in file or folder names (the path separators are split on first)
+_INVALID_NAME_CHARS = frozenset('<>:"|?*')
+
+
+def _batch_quote(path: str) -> str:
+    """Quote a path for a .bat line; `%` is doubled so cmd does not expand or drop it."""
+    return '"' + path.replace("%", "%%") + '"'
+
+
+def _normalize_folder(folder: Any) -> Optional[str]:
+    """Return a safe relative Windows folder path, or None if the folder is unusable."""
+    if not isinstance(folder, str):
+        return None
+    parts = [p.strip() for p in folder.replace("/", "\\").split("\\") if p.strip()]
+    if not parts or any(p in (".", "..") or _INVALID_NAME_CHARS.intersection(p) for p in parts):
+        return None
+    return "\\".join(parts)
+
+
+def parse_folder_assignments(reply_text: str, relative_files: List[str]) -> Dict[str, str]:
+    """
+    Turn the LLM's {"assignments": [{"file", "folder"}]} reply into {relative_file: folder}.
+    Entries naming files that were not scanned, or unusable folders, are dropped with a warning.
+    """
+    parsed = _parse_json_object(reply_text or "")
+    if parsed is None:
+        print("❌ Could not parse folder assignments from the LLM reply")
+        return {}
+
+    known_files = {f.replace("\\", "/"): f for f in relative_files}
+    assignments: Dict[str, str] = {}
+    for item in parsed.get("assignments") or []:
+        if not isinstance(item, dict):
+            continue
+        file_name, folder = item.get("file"), _normalize_folder(item.get("folder"))
+        if isinstance(file_name, str):
+            file_name = known_files.get(file_name.replace("\\", "/"), file_name)
+        if file_name not in known_files.values():
+            print(f"⚠️ Ignoring assignment for unknown file: {file_name}")
+        elif folder is None:
+            print(f"⚠️ Ignoring invalid folder for {file_name}: {item.get('folder')}")
+        else:
+            assignments[file_name] = folder
+    return assignments
+
+
+def summarize_file_list(relative_files: List[str]) -> str:
+    """
+    Compact listing for large directories: one line per extension with the file count,
+    the folders they live in, and a spread-out sample of names.
+    """
+    by_ext: Dict[str, List[str]] = {}
+    for file_name in relative_files:
+        by_ext.setdefault(os.path.splitext(file_name)[1].lower(), []).append(file_name)
+
+    lines = []
+    for ext, files in sorted(by_ext.items(), key=lambda item: (-len(item[1]), item[0])):
+        dirs = sorted({os.path.dirname(f) or "." for f in files})
+        dir_text = ", ".join(dirs[:COMPACT_SAMPLE_SIZE])
+        if len(dirs) > COMPACT_SAMPLE_SIZE:
+            dir_text += f", ... (+{len(dirs) - COMPACT_SAMPLE_SIZE} more)"
+        sample = files[::max(1, len(files) // COMPACT_SAMPLE_SIZE)][:COMPACT_SAMPLE_SIZE]
+        lines.append(
+            f"- {len(files)} {ext or '(no extension)'} files under {dir_text} "
+            f"(showing {len(sample)}): {', '.join(sample)}"
+        )
+    return "\n".join(lines)
+
+
+def parse_extension_assignments(reply_text: str, relative_files: List[str]) -> Dict[str, str]:
+    """
+    Expand the LLM's {"extensions": {ext: folder}} reply into {relative_file: folder}.
+    Files whose extension has no usable folder are left where they are, with a warning.
+    """
+    parsed = _parse_json_object(reply_text or "")
+    mapping = parsed.get("extensions") if parsed else None
+    if not isinstance(mapping, dict):
+        print("❌ Could not parse extension assignments from the LLM reply")
+        return {}
+
+    folders: Dict[str, str] = {}
+    for ext, folder in mapping.items():
+        if not isinstance(ext, str):
+            continue
+        ext = ext.strip().lower()
+        ext = ext if ext.startswith(".") else f".{ext}"
+        normalized = _normalize_folder(folder)
+        if normalized is None:
+            print(f"⚠️ Ignoring invalid folder for {ext}: {folder}")
+        else:
+            folders[ext] = normalized
+
+    assignments: Dict[str, str] = {}
+    unassigned = set()
+    for file_name in relative_files:
+        ext = os.path.splitext(file_name)[1].lower()
+        if ext in folders:
+            assignments[file_name] = folders[ext]
+        else:
+            unassigned.add(ext)
+    for ext in sorted(unassigned):
+        print(f"⚠️ No folder assigned for {ext} files; leaving them in place")
+
+    # Every file of an extension lands in one folder, so same-named files would overwrite each
+    # other; keep their source subdirectory under the target folder instead (Code\\src\\a\\f1.py)
+    by_destination: Dict[Tuple[str, str], List[str]] = {}
+    for file_name, folder in assignments.items():
+        key = (folder.lower(), ntpath.basename(file_name.replace("/", "\\")).lower())
+        by_destination.setdefault(key, []).append(file_name)
+    for clashing in by_destination.values():
+        if len(clashing) < 2:
+            continue
+        for file_name in clashing:
+            source_dir = ntpath.dirname(file_name.replace("/", "\\"))
+            if source_dir:
+                assignments[file_name] = ntpath.join(assignments[file_name], source_dir)
+    return assignments
+
+
+def build_organization_script(assignments: Dict[str, str], relative_files: Optional[List[str]] = None) -> str:
+    """
+    Render {relative_file: folder} as mkdir/move commands in Windows CMD syntax.
+
+    `move` silently overwrites its destination, so files whose destination would clash with
+    another moved file, or with a scanned file that stays where it is (relative_files), are
+    left in place with a warning; every move is also guarded by `if not exist`.
+    """
+    moves = {}
+    for file_name, folder in assignments.items():
+        source = file_name.replace("/", "\\")
+        if ntpath.dirname(source).lower() == folder.lower():
+            continue  # already in its target folder
+        destination = ntpath.join(folder, ntpath.basename(source))
+        moves[source] = (folder, destination)
+
+    by_destination: Dict[str, List[str]] = {}
+    for source, (_, destination) in moves.items():
+        by_destination.setdefault(destination.lower(), []).append(source)
+    staying = {
+        f.replace("/", "\\").lower() for f in (relative_files or []) if f.replace("/", "\\") not in moves
+    }
+    for destination, sources in by_destination.items():
+        if len(sources) > 1 or destination in staying:
+            print(f"⚠️ Leaving {', '.join(sources)} in place: destination {moves[sources[0]][1]} would be overwritten")
+            for source in sources:
+                del moves[source]
+
+    # cmd reads .bat files in the OEM code page; switch to UTF-8 so non-ASCII names survive
+    lines = ["chcp 65001 >nul"]
+    created = set()
+    for folder, _ in moves.values():
+        if folder not in created:
+            created.add(folder)
+            target = _batch_quote(folder + "\\")
+            lines.append(f"if not exist {target} mkdir {_batch_quote(folder)}")
+    lines.append("")
+    for source, (folder, destination) in moves.items():
+        target = _batch_quote(folder + "\\")
+        lines.append(f"if not exist {_batch_quote(destination)} move {_batch_quote(source)} {target}")
+    return "\n".join(lines) + "\n"
+
 
 def generate_organization_plan(
     directory_path: str,
@@ -418,7 +1005,8 @@ def generate_organization_plan(
     print(f"📁 Output directory: {output_dir}")
 
     # Step 1: Scan for supported files
-    supported_files = scan_directory_for_files(directory_path)
+    scanned = scan_directory_entries(directory_path)
+    supported_files = list(scanned)
     if not supported_files:
         return {"success": False, "error": "No supported files found"}
 
@@ -426,63 +1014,174 @@ def generate_organization_plan(
         supported_files = supported_files[:max_files]
         print(f"⚠️ Limited to {max_files} files")
 
-    # Step 2: Upload each file
-    file_ids = []
-    for file_path in supported_files:
-        upload_result = upload_file_to_amplify(
-            file_path=file_path,
-            knowledge_base="document_analysis",
-            tags=["document_analysis", "organization_plan"],
-            rag_on=True,
+    # Step 2: Reuse files uploaded by a previous run when their content is unchanged. Hashes come
+    # from local files and the scan index only, so unchanged OneDrive placeholders stay undownloaded.
+    file_id_cache = load_file_id_cache()
+    placeholders = [p for p in supported_files if scanned[p].get("placeholder")]
+    file_hashes = get_file_hashes(
+        directory_path,
+        [p for p in supported_files if not scanned[p].get("placeholder") or scanned[p].get("sha256")],
+    )
+
+    cache_pruned = False
+
+    def fetch_live_file_ids() -> set:
+        nonlocal cache_pruned
+        cached_hashes = [h for h in set(file_hashes.values()) if h in file_id_cache]
+        if not cached_hashes:
+            return set()
+        live_ids, complete = list_live_file_ids(
+            min(file_id_cache[h].get("uploaded_at", time.time()) for h in cached_hashes)
         )
-        if upload_result:
-            file_id = wait_for_file_processing(os.path.basename(file_path))
+        # Forget files deleted on the Amplify side, but only when the whole listing was seen
+        if complete:
+            for h in cached_hashes:
+                if file_id_cache[h].get("file_id") not in live_ids:
+                    del file_id_cache[h]
+                    cache_pruned = True
+        return live_ids
+
+    def reusable_file_id(file_path: str) -> Optional[str]:
+        file_hash = file_hashes.get(file_path)
+        cached = file_id_cache.get(file_hash) if file_hash else None
+        if cached and cached.get("file_id") in live_file_ids:
+            return cached["file_id"]
+        return None
+
+    live_file_ids = fetch_live_file_ids()
+
+    # Step 3: Hydrate, in parallel, only the placeholders that will actually be read
+    hydrated = hydrate_files_with_robocopy([p for p in placeholders if not reusable_file_id(p)])
+    local_paths = {path: hydrated_path for path, hydrated_path in hydrated.items() if hydrated_path}
+
+    try:
+        unhashed = [p for p in hydrated if p not in file_hashes]
+        if unhashed:
+            file_hashes.update(get_file_hashes(directory_path, unhashed, local_paths))
+            if any(file_hashes[p] in file_id_cache for p in unhashed):
+                live_file_ids = fetch_live_file_ids()
+
+        # Step 4: Upload the remaining files (concurrently; the work is network-bound)
+        newly_uploaded: List[str] = []
+        claimed_ids: set = set()
+
+        def upload_and_wait(file_path: str) -> Optional[str]:
+            file_hash = file_hashes.get(file_path)
+            reused_id = reusable_file_id(file_path)
+            if reused_id:
+                print(f"♻️ Reusing uploaded file for unchanged content: {file_path} (ID: {reused_id})")
+                return reused_id
+
+            upload_started = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+            upload_result = upload_file_to_amplify(
+                file_path=file_path,
+                knowledge_base="document_analysis",
+                tags=["document_analysis", "organization_plan"],
+                rag_on=True,
+                local_path=local_paths.get(file_path),
+                skip_placeholder_check=True,  # placeholders were detected by the scan and hydrated above
+            )
+            if not upload_result:
+                return None
+            # Same-named files in different folders upload concurrently, so match on the upload's
+            # own id/key, and never hand the same id to two files
+            file_id = wait_for_file_processing(
+                os.path.basename(file_path),
+                file_key=upload_result.get("id") or upload_result.get("key"),
+                claimed_ids=claimed_ids,
+                uploaded_after=upload_started,
+            )
             if file_id:
-                file_ids.append(file_id)
+                newly_uploaded.append(file_id)
+                if file_hash:
+                    file_id_cache[file_hash] = {"file_id": file_id, "uploaded_at": time.time()}
+            return file_id
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            # Files with identical bytes share one uploaded id; attach each data source once
+            file_ids = list(dict.fromkeys(
+                file_id for file_id in executor.map(upload_and_wait, supported_files) if file_id
+            ))
+    finally:
+        cleanup_hydrated_copies(hydrated)
+
+    if newly_uploaded or cache_pruned:
+        save_file_id_cache(file_id_cache)
 
     if not file_ids:
         return {"success": False, "error": "No files uploaded"}
 
     # Build list of relative file paths (important so the model doesn't invent files)
-    relative_files = [os.path.relpath(path, start=directory_path) for path in supported_files]
+    relative_files = relative_paths(directory_path, supported_files)
+
+    if newly_uploaded:
+        print("\n⏳ Allowing a short pause for RAG/indexing (30s)...")
+        time.sleep(30)
+
+    # Step 5: Build prompt — the model only classifies; the .bat is generated locally.
+    # Large listings are compressed to per-extension summaries; the files themselves are still
+    # attached as data sources, so the model classifies by extension instead of file by file.
+    compact = len(relative_files) > COMPACT_PROMPT_THRESHOLD
+    if compact:
+        organization_prompt = f"""You are a professional document organizer.
 
-    print("\n⏳ Allowing a short pause for RAG/indexing (30s)...")
-    time.sleep(30)
+The directory contains {len(relative_files)} files, summarized by extension:
+{summarize_file_list(relative_files)}
 
-    # Step 3: Build prompt — force model to only use the actual files
-    organization_prompt = f"""You are a professional document organizer.
+Your task is to choose a target folder for each file extension above, giving a logical
+folder structure for these files.
+
+⚠️ Rules:
+- Respond with JSON only, in exactly this shape:
+  {{"extensions": {{"<extension from the list above>": "<target folder>"}}}}
+- Use the extensions exactly as listed above (including the leading dot).
+- Each target folder (the mapping's values) is a relative folder path; use backslashes (`\\`) for nested folders.
+- No explanations, no markdown.
+"""
+        max_tokens = min(1500, 300 + 40 * len({os.path.splitext(f)[1].lower() for f in relative_files}))
+    else:
+        organization_prompt = f"""You are a professional document organizer.
 
 Here are the {len(relative_files)} files currently in the directory:
 {chr(10).join(relative_files)}
 
-Your task is to generate a valid Windows Command Prompt (.bat) script that organizes
-*only these files* into a logical folder structure.
+Your task is to assign *only these files* to folders in a logical folder structure.
 
 ⚠️ Rules:
-- Use `mkdir` to create any needed folders.
-- Use `move` with the exact relative file paths listed above as the source.
-- Use backslashes (`\\`) in all paths.
+- Respond with JSON only, in exactly this shape:
+  {{"assignments": [{{"file": "<relative path from the list above>", "folder": "<target folder>"}}]}}
+- Use the exact relative file paths listed above for "file".
+- "folder" is a relative folder path; use backslashes (`\\`) for nested folders.
 - Do not invent filenames that are not listed above.
-- Output only raw commands line by line, no explanations.
+- No explanations, no markdown.
 """
+        max_tokens = min(4000, 500 + 40 * len(relative_files))
 
-    print("🔎 Sending prompt to Amplify (strict Windows CMD prompt instructions)...")
+    print(f"🔎 Sending prompt to Amplify (JSON {'per-extension' if compact else 'per-file'} folder assignments)...")
     organization_result = chat_with_amplify(
         model=model,
         temperature=0.3,
-        max_tokens=4000,
+        max_tokens=max_tokens,
         data_source_ids=file_ids,
         message=organization_prompt,
-        system_message="You are a professional command-line script generator. Only output mkdir and move commands in valid Windows CMD syntax.",
+        system_message="You are a professional document organizer. Only output JSON folder assignments.",
     )
 
     if not organization_result:
         return {"success": False, "error": "LLM failed"}
 
-    # Step 4: Save results
+    reply_text = _extract_text_from_amplify_response(organization_result)
+    if compact:
+        assignments = parse_extension_assignments(reply_text, relative_files)
+    else:
+        assignments = parse_folder_assignments(reply_text, relative_files)
+    if not assignments:
+        return {"success": False, "error": "LLM returned no usable folder assignments"}
+
+    # Step 6: Save results
     os.makedirs(output_dir, exist_ok=True)
     output_file_path = os.path.join(output_dir, "organization_commands.bat")
-    plan_content = organization_result.get("data", "")
+    plan_content = build_organization_script(assignments, relative_files)
 
     with open(output_file_path, "w", encoding="utf-8") as f:
         f.write(plan_content)
@@ -490,7 +1189,6 @@ Your task is to generate a valid Windows Command Prompt (.bat) script that organ
     print(f"✅ Organization commands saved to: {output_file_path}")
     return {"success": True, "output_file_path": output_file_path}
 
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Analyze documents to generate an organization plan.")
     parser.add_argument("directory", type=str, nargs="?", default=".", help="Directory containing documents (default: current dir)")